@@ -22,11 +22,24 @@ Test cases can be run with:
 While debugging just these tests it's convenient to use this:
     nosetests --stop tests/test_models.py:TestProductModel
 
+The tests run against PostgreSQL by default, only because that is the
+DATABASE_URI default here and in service/config.py. Setting it to an
+in-memory SQLite database runs the whole suite without PostgreSQL:
+    DATABASE_URI="sqlite:///file:memdb1?mode=memory&cache=shared&uri=true"
+
+They can also be spread across processes with pytest-xdist:
+    pytest -n auto tests/test_models.py
+
 """
 import os
+import io
+import csv
 import logging
 import unittest
-from decimal import Decimal
+from factory.random import get_random_state, reseed_random, set_random_state
+from sqlalchemy import event, func, select, text
+from sqlalchemy.orm import scoped_session, sessionmaker
+from sqlalchemy.pool import StaticPool
 from service.models import Product, Category, db, DataValidationError
 from service import app
 from tests.factories import ProductFactory
@@ -36,6 +49,20 @@ DATABASE_URI = os.getenv(
 )
 
 
+def _begin_sqlite(conn):
+    """Emits BEGIN for SQLite since pysqlite's implicit transactions break SAVEPOINTs"""
+    conn.exec_driver_sql("BEGIN")
+
+
+def _restore_config(saved_config: dict):
+    """Puts back app.config values saved before a test class changed them"""
+    for key, value in saved_config.items():
+        if value is None:
+            app.config.pop(key, None)
+        else:
+            app.config[key] = value
+
+
 ######################################################################
 #  P R O D U C T   M O D E L   T E S T   C A S E S
 ######################################################################
@@ -43,44 +70,165 @@ DATABASE_URI = os.getenv(
 class TestProductModel(unittest.TestCase):
     """Test Cases for Product Model"""
 
+    # Batches larger than this are loaded with COPY on PostgreSQL
+    COPY_THRESHOLD = 100
+
     @classmethod
     def setUpClass(cls):
         """This runs once before the entire test suite"""
+        # Every change to shared state registers its own undo as a class cleanup,
+        # so it is reverted even if a later step here raises
+        saved_config = {
+            key: app.config.get(key)
+            for key in ("SQLALCHEMY_DATABASE_URI", "SQLALCHEMY_ENGINE_OPTIONS")
+        }
+        cls.addClassCleanup(_restore_config, saved_config)
         app.config["TESTING"] = True
         app.config["DEBUG"] = False
         app.config["SQLALCHEMY_DATABASE_URI"] = DATABASE_URI
+        if DATABASE_URI.startswith("sqlite"):
+            # One shared in-memory connection, with pysqlite's own transaction
+            # handling turned off so that _begin_sqlite() can take over
+            engine_options = {
+                "poolclass": StaticPool,
+                "connect_args": {"check_same_thread": False, "isolation_level": None},
+            }
+        else:
+            # The suite holds one pooled connection for its whole run, so keep
+            # the pool small and skip the per-checkout liveness ping. Test data
+            # is throwaway, so commits don't need to wait for the WAL flush.
+            engine_options = {
+                "connect_args": {"options": "-c synchronous_commit=off"},
+                "pool_size": 2,
+                "max_overflow": 0,
+                "pool_pre_ping": False,
+                "pool_recycle": -1,
+            }
+        app.config["SQLALCHEMY_ENGINE_OPTIONS"] = engine_options
         app.logger.setLevel(logging.CRITICAL)
+        # Seed the fuzzy attributes and Faker for reproducible products, and
+        # build one up front so Faker's lazy provider setup isn't charged to a test
+        cls.addClassCleanup(set_random_state, get_random_state())
+        reseed_random(0)
+        ProductFactory.build()
         Product.init_db(app)
-
-    @classmethod
-    def tearDownClass(cls):
-        """This runs once after the entire test suite"""
-        db.session.close()
+        # Build the bulk INSERT once so _bulk_create() reuses the same cached statement
+        table = Product.__table__
+        cls._insert_columns = [column.name for column in table.columns if not column.primary_key]
+        cls._insert_stmt = table.insert()
+        cls.dialect = db.engine.dialect.name
+        if cls.dialect == "sqlite":
+            event.listen(db.engine, "begin", _begin_sqlite)
+            cls.addClassCleanup(event.remove, db.engine, "begin", _begin_sqlite)
+        # Run the whole suite inside one outer transaction that is never committed
+        cls.connection = db.engine.connect()
+        cls.addClassCleanup(cls.connection.close)
+        cls.trans = cls.connection.begin()
+        cls.addClassCleanup(cls.trans.rollback)
+        if cls.dialect == "postgresql":
+            # Each pytest-xdist worker gets its own schema so they never share rows
+            worker = os.getenv("PYTEST_XDIST_WORKER")
+            if worker:
+                cls.connection.execute(text(f"CREATE SCHEMA IF NOT EXISTS tw_{worker}"))
+                cls.connection.execute(text(f"SET LOCAL search_path TO tw_{worker}"))
+                db.metadata.create_all(cls.connection)
+            cls.connection.execute(text("TRUNCATE TABLE product RESTART IDENTITY CASCADE"))
+        else:
+            cls.connection.execute(text("DELETE FROM product"))
+        # Bind the session to that transaction so commit() only releases a SAVEPOINT
+        cls.addClassCleanup(setattr, db, "session", db.session)
+        db.session = scoped_session(
+            sessionmaker(bind=cls.connection, join_transaction_mode="create_savepoint")
+        )
+        cls.addClassCleanup(db.session.close)
 
     def setUp(self):
         """This runs before each test"""
-        db.session.query(Product).delete()  # clean up the last tests
-        db.session.commit()
+        self.savepoint = self.connection.begin_nested()
 
     def tearDown(self):
         """This runs after each test"""
-        db.session.remove()
+        db.session.close()
+        self.savepoint.rollback()  # clean up the last tests
 
     ######################################################################
-    #  T E S T   C A S E S
+    #  U T I L I T Y   M E T H O D S
     ######################################################################
 
-    def test_create_a_product(self):
-        """It should Create a product and assert that it exists"""
-        product = Product(name="Fedora", description="A red hat", price=12.50, available=True, category=Category.CLOTHS)
-        self.assertEqual(str(product), "<Product Fedora id=[None]>")
-        self.assertTrue(product is not None)
-        self.assertEqual(product.id, None)
-        self.assertEqual(product.name, "Fedora")
-        self.assertEqual(product.description, "A red hat")
-        self.assertEqual(product.available, True)
-        self.assertEqual(product.price, 12.50)
-        self.assertEqual(product.category, Category.CLOTHS)
+    @classmethod
+    def _bulk_create(cls, products: list) -> list:
+        """Saves a batch of products with a single executemany INSERT"""
+        # This is a Core insert on purpose: unlike session.add_all() it skips the
+        # ORM unit of work and mapper events. The ids are reserved up front and
+        # inserted explicitly, since executemany RETURNING doesn't promise order
+        for product, product_id in zip(products, cls._next_ids(len(products))):
+            product.id = product_id
+        if cls.dialect == "postgresql" and len(products) > cls.COPY_THRESHOLD:
+            return cls._copy_insert(products)
+        rows = [
+            dict({name: getattr(product, name) for name in cls._insert_columns}, id=product.id)
+            for product in products
+        ]
+        db.session.execute(cls._insert_stmt, rows)
+        db.session.commit()
+        return products
+
+    @classmethod
+    def _next_ids(cls, count: int) -> list:
+        """Reserves primary keys for a batch of products before inserting them"""
+        if cls.dialect == "postgresql":
+            return db.session.scalars(
+                text("SELECT nextval(pg_get_serial_sequence('product', 'id')) FROM generate_series(1, :count)"),
+                {"count": count},
+            ).all()
+        # SQLite has no sequence, but nothing else writes inside the suite's transaction
+        start = db.session.scalar(text("SELECT coalesce(max(id), 0) FROM product"))
+        return list(range(start + 1, start + count + 1))
+
+    @classmethod
+    def _copy_insert(cls, products: list) -> list:
+        """Saves a large batch of products by streaming it through COPY FROM STDIN"""
+        # The ids were already reserved by _bulk_create(), since COPY can't return them
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        for product in products:
+            values = [getattr(product, name) for name in cls._insert_columns]
+            writer.writerow([product.id] + [value.name if isinstance(value, Category) else value for value in values])
+        buffer.seek(0)
+        columns = ", ".join(["id"] + cls._insert_columns)
+        with db.session.connection().connection.cursor() as cursor:
+            cursor.copy_expert(f"COPY product ({columns}) FROM STDIN WITH CSV", buffer)
+        db.session.commit()
+        return products
+
+    @classmethod
+    def _persist(cls, products: list) -> list:
+        """Adds a batch of products to the session and saves them with one flush"""
+        for product in products:
+            product.id = None  # id must be none to generate next primary key
+        db.session.add_all(products)
+        db.session.flush()
+        return products
+
+    @classmethod
+    def _count_products(cls) -> int:
+        """Counts the products in the database without loading any of them"""
+        return db.session.scalar(select(func.count()).select_from(Product))  # pylint: disable=not-callable
+
+    @classmethod
+    def _bulk_build_and_insert(cls, count: int) -> list:
+        """Builds a batch of products without the ORM and saves them in one INSERT"""
+        return cls._bulk_create(ProductFactory.build_batch(count))
+
+    def _assert_bulk_saved(self, products: list):
+        """Asserts that a bulk insert gave every product its own id"""
+        ids = [product.id for product in products]
+        self.assertNotIn(None, ids)
+        self.assertEqual(len(set(ids)), len(products))
+
+    ######################################################################
+    #  T E S T   C A S E S
+    ######################################################################
 
     def test_add_a_product(self):
         """It should Create a product and add it to the database"""
@@ -97,7 +245,7 @@ class TestProductModel(unittest.TestCase):
         new_product = products[0]
         self.assertEqual(new_product.name, product.name)
         self.assertEqual(new_product.description, product.description)
-        self.assertEqual(Decimal(new_product.price), product.price)
+        self.assertEqual(new_product.price, product.price)
         self.assertEqual(new_product.available, product.available)
         self.assertEqual(new_product.category, product.category)
 
@@ -160,100 +308,132 @@ class TestProductModel(unittest.TestCase):
         product = ProductFactory()
         # Call the create() method on the product to save it to the database.
         product.create()
-        # Assert  if the length of the list returned by Product.all() is equal to 1,
+        # Assert if the number of products in the database is equal to 1,
         # to verify that after creating a product and saving it to the database,
         # there is only one product in the system.
-        products = Product.all()
-        self.assertEqual(len(products), 1)
+        self.assertEqual(self._count_products(), 1)
         # Call the delete() method on the product object, to remove the product from the database.
         product.delete()
-        # Assert if the length of the list returned by Product.all() is now equal to 0,
+        # Assert if the number of products in the database is now equal to 0,
         # indicating that the product has been successfully deleted from the database.
-        products = Product.all()
-        self.assertEqual(len(products), 0)
+        self.assertEqual(self._count_products(), 0)
 
     def test_list_all_product(self):
         """It should list all the Product"""
-        products = Product.all()
-        # Assert if the products list is empty, indicating that there are no products
-        # in the database at the beginning of the test case.
-        self.assertEqual(len(products), 0)
-        # Use for loop to create five Product objects using a ProductFactory() and
-        # call the create() method on each product to save them to the database.
-        for _ in range(5):
-            product = ProductFactory()
-            # Fetch all products from the database again using product.all()
-            product.create()
-        products = Product.all()
-        # Assert if the length of the products list is equal to 5, to verify that the five products
+        # Assert if there are no products in the database at the beginning of the test case.
+        self.assertEqual(self._count_products(), 0)
+        # Create five Product objects using a ProductFactory() and save them
+        # to the database with a single flush of the session.
+        self._persist(ProductFactory.build_batch(5))
+        # Assert if the number of products is equal to 5, to verify that the five products
         # created in the previous step have been successfully added to the database.
-        self.assertEqual(len(products), 5)
+        self.assertEqual(self._count_products(), 5)
 
     def test_find_a_product_by_name(self):
         """It should  find a Product by name"""
-        products = ProductFactory.create_batch(5)
-        for product in products:
-            product.create()
+        products = self._bulk_build_and_insert(5)
+        self._assert_bulk_saved(products)
         name = products[0].name
-        count = len([product for product in products if product.name == name])
-        found = Product.find_by_name(name)
-        self.assertEqual(found.count(), count)
+        count = sum(1 for product in products if product.name == name)
+        found = Product.find_by_name(name).all()
+        self.assertEqual(len(found), count)
         for product in found:
             self.assertEqual(product.name, name)
 
     def test_find_a_product_by_availability(self):
         """It should  find a Product by availability"""
-        products = ProductFactory.create_batch(10)
-        for product in products:
-            product.create()
+        products = self._bulk_build_and_insert(10)
+        self._assert_bulk_saved(products)
         available = products[0].available
-        count = len([product for product in products if product.available == available])
-        found = Product.find_by_availability(available)
-        self.assertEqual(found.count(), count)
+        count = sum(1 for product in products if product.available == available)
+        found = Product.find_by_availability(available).all()
+        self.assertEqual(len(found), count)
         for product in found:
             self.assertEqual(product.available, available)
 
     def test_find_a_product_by_category(self):
         """It should  find a Product by category"""
-        products = ProductFactory.create_batch(10)
-        for product in products:
-            product.create()
+        products = self._bulk_build_and_insert(10)
+        self._assert_bulk_saved(products)
         category = products[0].category
-        count = len([product for product in products if product.category == category])
-        found = Product.find_by_category(category)
-        self.assertEqual(found.count(), count)
+        count = sum(1 for product in products if product.category == category)
+        found = Product.find_by_category(category).all()
+        self.assertEqual(len(found), count)
         for product in found:
             self.assertEqual(product.category, category)
 
     def test_find_a_product_by_price(self):
         """It should find a Product by price"""
-        products = ProductFactory.create_batch(10)
-        for product in products:
-            product.create()
+        products = self._bulk_build_and_insert(10)
+        self._assert_bulk_saved(products)
         price = products[0].price
-        count = len([product for product in products if product.price == price])
-        found = Product.find_by_price(price)
-        self.assertEqual(found.count(), count)
+        count = sum(1 for product in products if product.price == price)
+        found = Product.find_by_price(price).all()
+        self.assertEqual(len(found), count)
         for product in found:
             self.assertEqual(product.price, price)
 
+    def test_bulk_create_a_large_batch(self):
+        """It should save a batch larger than COPY_THRESHOLD with COPY"""
+        if self.dialect != "postgresql":
+            self.skipTest("COPY FROM STDIN is only available on PostgreSQL")
+        products = self._bulk_build_and_insert(self.COPY_THRESHOLD + 1)
+        self._assert_bulk_saved(products)
+        self.assertEqual(self._count_products(), len(products))
+        # Read one back to check every column made it through the CSV
+        product = products[-1]
+        found_product = Product.find(product.id)
+        self.assertEqual(found_product.name, product.name)
+        self.assertEqual(found_product.description, product.description)
+        self.assertEqual(found_product.price, product.price)
+        self.assertEqual(found_product.available, product.available)
+        self.assertEqual(found_product.category, product.category)
+
+
+######################################################################
+#  I N - M E M O R Y   P R O D U C T   T E S T   C A S E S
+######################################################################
+class TestProductPure(unittest.TestCase):
+    """Test Cases for Product behavior that never touches the database"""
+
+    def test_create_a_product(self):
+        """It should Create a product and assert that it exists"""
+        product = Product(name="Fedora", description="A red hat", price=12.50, available=True, category=Category.CLOTHS)
+        self.assertEqual(str(product), "<Product Fedora id=[None]>")
+        self.assertTrue(product is not None)
+        self.assertEqual(product.id, None)
+        self.assertEqual(product.name, "Fedora")
+        self.assertEqual(product.description, "A red hat")
+        self.assertEqual(product.available, True)
+        self.assertEqual(product.price, 12.50)
+        self.assertEqual(product.category, Category.CLOTHS)
+
     def test_deserialize_invalid_data(self):
         """It should raise a DataValidationError when the product data is malformed or incomplete"""
-
-        # Create malformed data where price is valid (decimal) but 'available' is an invalid type
-        invalid_data = {
+        valid_data = {
             "name": "Test Product",
             "description": "This is a test product",
-            "price": 12.50,  # Valid decimal type for price
-            "available": "maybe",  # Invalid type for available (should be boolean)
+            "price": 12.50,
+            "available": True,
             "category": "CLOTHS"
         }
-        # Try to deserialize and catch the exception
+        missing_name = dict(valid_data)
+        del missing_name["name"]
+        # Each case is the malformed payload and the message it should raise
+        cases = [
+            # price is valid (decimal) but 'available' is an invalid type (should be boolean)
+            (dict(valid_data, available="maybe"), "Invalid type for boolean [available]: <class 'str'>"),
+            (missing_name, "Invalid product: missing name"),
+        ]
+        product = Product()
+        for invalid_data, message in cases:
+            with self.subTest(message=message):
+                with self.assertRaises(DataValidationError) as context:
+                    product.deserialize(invalid_data)
+                self.assertEqual(str(context.exception), message)
+        # The rest of this message is Python's own TypeError text, so only check our prefix
         with self.assertRaises(DataValidationError) as context:
-            product = Product()
-            product.deserialize(invalid_data)
-        # Check if the exception message matches the expected one
-        self.assertEqual(
-            str(context.exception),
-            "Invalid type for boolean [available]: <class 'str'>"
+            product.deserialize(None)
+        self.assertTrue(
+            str(context.exception).startswith("Invalid product: body of request contained bad or no data")
         )